@@ -1,20 +1,33 @@
 from __future__ import absolute_import, division, print_function
 
 from abc import ABCMeta, abstractmethod, abstractproperty
+from collections import deque
+import functools
 import gc
+import multiprocessing
 import os
+import random
 import sys
+import threading
 import warnings
 
 from keras.callbacks import ModelCheckpoint, EarlyStopping
 from keras.layers import Activation, Layer, LeakyReLU, PReLU, ThresholdedReLU
+from keras.models import clone_model
+from keras.optimizers import get as get_optimizer
+from keras.utils import Sequence
 
+import numpy as np
 import six
+from six.moves import queue
 
 from energyflow.utils import iter_or_rep
 
 __all__ = ['ArchBase', 'NNBase']
 
+# sentinel indicating that a hyperparameter has no default value
+_REQUIRED = object()
+
 ###############################################################################
 # ArchBase
 ###############################################################################
@@ -56,16 +69,20 @@ class ArchBase(six.with_metaclass(ABCMeta, object)):
         # construct model
         self._construct_model()
 
-    def _proc_arg(self, name, **kwargs):
-        if 'old' in kwargs and kwargs['old'] in self.hps:
-            old = kwargs['old']
+    def _proc_arg(self, name, default=_REQUIRED, old=None):
+
+        # handle deprecated name for this hyperparameter
+        if old is not None and old in self.hps:
             m = ('\'{}\' is deprecated and will be removed in the future, '
                  'use \'{}\' instead.').format(old, name)
             warnings.warn(FutureWarning(m))
-            kwargs['default'] = self.hps.pop(old)
+            default = self.hps.pop(old)
 
-        return (self.hps.pop(name, kwargs['default']) if 'default' in kwargs 
-                                                      else self.hps.pop(name))
+        # required hyperparameters raise a KeyError if missing
+        if default is _REQUIRED:
+            return self.hps.pop(name)
+
+        return self.hps.pop(name, default)
 
     def _verify_empty_hps(self):
 
@@ -186,7 +203,14 @@ class NNBase(ArchBase):
         - **optimizer**=`'adam'` : Keras optimizer or _str_
             - A [Keras optimizer](https://keras.io/optimizers/) instance or a
             string referring to one (in which case the default arguments are 
-            used).
+            used, unless `optimizer_opts` is given). A Keras optimizer class
+            is also accepted.
+        - **optimizer_opts**=`{}` : _dict_
+            - Dictionary of keyword arguments used to construct the optimizer
+            when `optimizer` is a string or a class, such as
+            `{'learning_rate': 1e-4, 'amsgrad': True, 'epsilon': 1e-7}`. The
+            optimizer is constructed once, when the model is created. Must be
+            empty if `optimizer` is already an optimizer instance.
         - **metrics**=`['accuracy']` : _list_ of _str_
             - The [Keras metrics](https://keras.io/metrics/) to apply to the
             model.
@@ -195,6 +219,13 @@ class NNBase(ArchBase):
             [`compile`](https://keras.io/models/model/#compile) method of the
             model. `loss`, `optimizer`, and `metrics` (see above) are included
             in this dictionary. All other values are the Keras defaults.
+        - **dtype_policy**=`None` : _str_
+            - If not `None`, the name of a [Keras mixed precision policy](https:
+            //keras.io/api/mixed_precision/policy/), such as `'mixed_float16'`
+            or `'mixed_bfloat16'`, used for the layers of the model. The output
+            layer and its activation are always computed in `float32` for
+            numerical stability. Requires a version of Keras with the
+            `mixed_precision` module.
 
         **Output Options**
 
@@ -222,6 +253,15 @@ class NNBase(ArchBase):
             callback, if it is present. `save_weights_only` (see above) is
             included in this dictionary. All other arguments are the Keras
             defaults.
+        - **async_checkpoint**=`False` : _bool_
+            - Whether weights saved during training by the `ModelCheckpoint`
+            callback are written to disk in a background thread, allowing
+            training to continue while the file is written. The weights are
+            copied to host memory before training resumes, so each file is a
+            consistent snapshot. Saves of the full model (i.e. when
+            `save_weights_only` is `False`) are always done synchronously.
+            Only relevant if `filepath` is set and `save_while_training` is
+            `True`.
         - **patience**=`None` : _int_
             - The number of epochs with no improvement after which the training
             is stopped (using the [`EarlyStopping`](https://keras.io/
@@ -242,15 +282,45 @@ class NNBase(ArchBase):
             (all Keras layers in a model are required to have unique names).
         - **compile**=`True` : _bool_
             - Whether the model should be compiled or not.
+        - **inference_only**=`False` : _bool_
+            - Whether the model will only be used for inference, for instance
+            to evaluate a trained model or the filters of an EFN. If `True`,
+            the model is not compiled (regardless of `compile`), so no
+            optimizer, loss, or metrics are created, and dropout layers, which
+            only act during training, are left out of the model. Weights saved
+            from a model constructed for training can be loaded into it.
+        - **jit_compile**=`False` : _bool_
+            - Whether the model should be compiled with XLA by passing
+            `jit_compile=True` to the `compile` method of the model. If the
+            installed version of Keras does not support this option, a warning
+            is issued and the model is compiled normally. A `jit_compile`
+            value in `compile_opts` takes precedence. Only relevant if
+            `compile` is `True`.
         - **summary**=`True` : _bool_
             - Whether a summary should be printed or not.
+        - **shared_memory**=`False` : _bool_
+            - Whether batches of a Keras `Sequence` passed to `fit` should be
+            produced by worker processes and handed back to the training
+            process through shared memory, rather than being pickled through
+            a pipe as Keras does when `use_multiprocessing=True`. The number
+            of processes and the number of batches computed ahead of time are
+            controlled by the `workers` and `max_queue_size` arguments of
+            `fit`, and `shuffle` controls whether the order of the batches is
+            shuffled each epoch. All arguments to `fit` other than the
+            `Sequence` must be passed by keyword. Requires Python 3.8 or later.
         """
 
-        # compilation
+        # compilation, with no optimizer constructed for a model used only for inference
+        self.inference_only = self._proc_arg('inference_only', default=False)
+        optimizer = self._proc_arg('optimizer', default='adam')
+        optimizer_opts = self._proc_arg('optimizer_opts', default={})
+        if not self.inference_only:
+            optimizer = _make_optimizer(optimizer, optimizer_opts)
         self.compile_opts = {'loss': self._proc_arg('loss', default='categorical_crossentropy'),
-                             'optimizer': self._proc_arg('optimizer', default='adam'),
+                             'optimizer': optimizer,
                              'metrics': self._proc_arg('metrics', default=['acc'])}
         self.compile_opts.update(self._proc_arg('compile_opts', default={}))
+        self.dtype_policy = self._proc_arg('dtype_policy', default=None)
 
         # add these attributes for historical reasons
         self.loss = self.compile_opts['loss']
@@ -270,6 +340,7 @@ class NNBase(ArchBase):
                 'save_weights_only': self._proc_arg('save_weights_only', default=False)}
         self.modelcheck_opts.update(self._proc_arg('modelcheck_opts', default={}))
         self.save_weights_only = self.modelcheck_opts['save_weights_only']
+        self.async_checkpoint = self._proc_arg('async_checkpoint', default=False)
 
         self.earlystop_opts = {'restore_best_weights': True, 'verbose': 1, 
                                'patience': self._proc_arg('patience', default=None)}
@@ -279,21 +350,17 @@ class NNBase(ArchBase):
         # flags
         self.name_layers = self._proc_arg('name_layers', default=True)
         self.compile = self._proc_arg('compile', default=True)
+        self.jit_compile = self._proc_arg('jit_compile', default=False)
         self.summary = self._proc_arg('summary', default=True)
+        self.shared_memory = self._proc_arg('shared_memory', default=False)
 
-    def _add_act(self, act):
-
-        # handle case of act as a layer
-        if isinstance(act, Layer):
-            self.model.add(act)
+    def _add_act(self, act, **kwargs):
+        self.model.add(_get_act_layer(act, **kwargs))
 
-        # handle case of act being a string and in ACT_DICT
-        elif isinstance(act, six.string_types) and act in ACT_DICT:
-            self.model.add(ACT_DICT[act]())
+    def _output_kwargs(self):
 
-        # default case of regular activation
-        else:
-            self.model.add(Activation(act))
+        # keep the output in float32 when using mixed precision
+        return {} if self.dtype_policy is None else {'dtype': 'float32'}
 
     def _proc_name(self, name):
         return name if self.name_layers else None
@@ -301,8 +368,24 @@ class NNBase(ArchBase):
     def _compile_model(self):
 
         # compile model if specified
-        if self.compile: 
-            self.model.compile(**self.compile_opts)
+        if self.compile and not self.inference_only: 
+
+            # use XLA if requested, unless compile_opts already says otherwise
+            compile_opts = dict(self.compile_opts)
+            if self.jit_compile:
+                compile_opts.setdefault('jit_compile', True)
+
+            try:
+                self.model.compile(**compile_opts)
+
+            # fall back if this version of Keras does not support jit_compile
+            except TypeError as e:
+                if not (self.jit_compile and 'jit_compile' in str(e)):
+                    raise
+                warnings.warn('jit_compile not supported by this version of Keras, '
+                              'compiling without it')
+                compile_opts.pop('jit_compile')
+                self.model.compile(**compile_opts)
 
             # print summary
             if self.summary: 
@@ -315,7 +398,8 @@ class NNBase(ArchBase):
 
         # do model checkpointing, used mainly to save model during training instead of at end
         if self.filepath and self.save_while_training:
-            callbacks.append(ModelCheckpoint(self.filepath, **self.modelcheck_opts))
+            checkpoint = AsyncModelCheckpoint if self.async_checkpoint else ModelCheckpoint
+            callbacks.append(checkpoint(self.filepath, **self.modelcheck_opts))
 
         # do early stopping, which no also handle loading best weights at the end
         if self.patience is not None:
@@ -324,6 +408,10 @@ class NNBase(ArchBase):
         # update any callbacks that were passed with the two we build in explicitly
         kwargs.setdefault('callbacks', []).extend(callbacks)
 
+        # feed batches of a Sequence through shared memory if requested
+        if self.shared_memory and len(args) and isinstance(args[0], Sequence):
+            args, kwargs = _shared_memory_fit_args(args, kwargs)
+
         # do the fitting
         hist = self.model.fit(*args, **kwargs)
 
@@ -347,13 +435,269 @@ class NNBase(ArchBase):
         return self._model
 
 
+###############################################################################
+# Optimizers
+###############################################################################
+
+def _make_optimizer(optimizer, optimizer_opts):
+
+    # construct an instance of an optimizer class, which Keras cannot interpret
+    if isinstance(optimizer, type):
+        return optimizer(**optimizer_opts)
+
+    # nothing to construct, let Keras handle the optimizer as usual
+    if not optimizer_opts:
+        return optimizer
+
+    # construct an instance of the class that the string refers to
+    if isinstance(optimizer, six.string_types):
+        return get_optimizer(optimizer).__class__(**optimizer_opts)
+
+    raise ValueError('optimizer_opts cannot be used with an optimizer instance')
+
+
+###############################################################################
+# Mixed precision
+###############################################################################
+
+def _with_dtype_policy(construct_model):
+    """Decorates a `_construct_model` method such that the model is built
+    with the global Keras dtype policy set to the `dtype_policy`
+    hyperparameter. The previous global policy is restored afterwards.
+    """
+
+    @functools.wraps(construct_model)
+    def wrapper(self):
+
+        # nothing to do if no policy was specified
+        if self.dtype_policy is None:
+            return construct_model(self)
+
+        try:
+            from keras import mixed_precision
+        except ImportError:
+            raise ImportError('dtype_policy requires a version of Keras with mixed_precision')
+
+        old_policy = mixed_precision.global_policy()
+        mixed_precision.set_global_policy(self.dtype_policy)
+        try:
+            return construct_model(self)
+        finally:
+            mixed_precision.set_global_policy(old_policy)
+
+    return wrapper
+
+
+###############################################################################
+# Callbacks
+###############################################################################
+
+class AsyncModelCheckpoint(ModelCheckpoint):
+
+    """A `ModelCheckpoint` callback which writes weights to disk in a
+    background thread. The weights are copied to host memory when the save is
+    requested and written out from a clone of the model, so training can
+    proceed while the file is being written. At most one snapshot waits to be
+    written at any time, and all pending writes are finished when training
+    ends. Saves of the full model are passed through to the model unchanged.
+    """
+
+    def set_model(self, model):
+        self._clone = clone_model(model)
+        super(AsyncModelCheckpoint, self).set_model(_AsyncSaveModel(model, self))
+
+    def on_train_begin(self, logs=None):
+        super(AsyncModelCheckpoint, self).on_train_begin(logs)
+
+        self._queue, self._error = queue.Queue(maxsize=1), None
+        self._thread = threading.Thread(target=self._write_weights)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def on_train_end(self, logs=None):
+
+        # wait for pending writes to finish
+        self._queue.put(None)
+        self._thread.join()
+
+        super(AsyncModelCheckpoint, self).on_train_end(logs)
+
+        # raise any error that occurred while writing
+        if self._error is not None:
+            raise self._error
+
+    def _save_weights(self, weights, args, kwargs):
+        self._queue.put((weights, args, kwargs))
+
+    def _write_weights(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+
+            weights, args, kwargs = item
+            try:
+                self._clone.set_weights(weights)
+                self._clone.save_weights(*args, **kwargs)
+            except Exception as e:
+                self._error = e
+
+class _AsyncSaveModel(object):
+
+    # stands in for a model inside AsyncModelCheckpoint, deferring weight saves
+    def __init__(self, model, checkpoint):
+        self._model = model
+        self._checkpoint = checkpoint
+
+    def save_weights(self, *args, **kwargs):
+        self._checkpoint._save_weights(self._model.get_weights(), args, kwargs)
+
+    def __getattr__(self, attr):
+        return getattr(self._model, attr)
+
+
+###############################################################################
+# Shared memory data feeding
+###############################################################################
+
+def _shared_memory_fit_args(args, kwargs):
+
+    # multiprocessing.shared_memory is new in python 3.8
+    try:
+        from multiprocessing import shared_memory
+    except ImportError:
+        raise ImportError('shared_memory requires python 3.8 or later')
+
+    # the number of epochs must be known in order to produce the right number of batches
+    if len(args) > 1:
+        raise ValueError('arguments to fit other than the Sequence must be passed '
+                         'by keyword when shared_memory is True')
+
+    # use only the first steps_per_epoch batches each epoch, as Keras does
+    sequence = args[0]
+    steps = kwargs.get('steps_per_epoch')
+    if steps is None:
+        steps = len(sequence)
+    elif steps > len(sequence):
+        raise ValueError('steps_per_epoch cannot exceed the length of the Sequence '
+                         'when shared_memory is True')
+
+    # the generator handles workers, shuffling, and queueing itself
+    epochs = kwargs.get('epochs', 1) - kwargs.get('initial_epoch', 0)
+    generator = _shared_memory_generator(sequence, epochs, steps=steps,
+                                         shuffle=kwargs.pop('shuffle', True),
+                                         workers=kwargs.pop('workers', 1),
+                                         max_queue_size=kwargs.pop('max_queue_size', 10))
+    kwargs.pop('use_multiprocessing', None)
+    kwargs['steps_per_epoch'] = steps
+
+    return (generator,), kwargs
+
+def _shared_memory_generator(sequence, epochs, steps=None, shuffle=True, workers=1, 
+                                                 max_queue_size=10):
+
+    for epoch in range(epochs):
+        inds = list(range(len(sequence)))
+        if shuffle:
+            random.shuffle(inds)
+        inds = inds[:steps]
+
+        # a fresh pool each epoch lets the workers see changes from on_epoch_end
+        pool = multiprocessing.Pool(max(workers, 1), initializer=_init_shm_worker, 
+                                                     initargs=(sequence,))
+        pending, inds = deque(), deque(inds)
+        try:
+
+            # fill the queue with batches being computed ahead of time
+            while len(inds) and len(pending) < max(max_queue_size, 1):
+                pending.append(pool.apply_async(_shm_get_batch, (inds.popleft(),)))
+
+            # get the next batch in order and replace it in the queue
+            while len(pending):
+                batch = _shm_load(pending.popleft().get())
+                if len(inds):
+                    pending.append(pool.apply_async(_shm_get_batch, (inds.popleft(),)))
+                yield batch
+
+        # free any shared memory that was never consumed, e.g. due to early stopping
+        finally:
+            for result in pending:
+                try:
+                    _shm_load(result.get())
+                except Exception:
+                    pass
+            pool.terminate()
+
+        sequence.on_epoch_end()
+
+_shm_sequence = None
+
+def _init_shm_worker(sequence):
+    global _shm_sequence
+    _shm_sequence = sequence
+
+def _shm_get_batch(i):
+    return _shm_dump(_shm_sequence[i])
+
+def _shm_dump(x):
+    from multiprocessing import resource_tracker, shared_memory
+
+    # recurse into containers of arrays
+    if isinstance(x, (list, tuple)):
+        return (type(x), [_shm_dump(y) for y in x])
+
+    if isinstance(x, np.ndarray) and x.nbytes > 0:
+
+        # fall back to sending the array itself if shared memory is exhausted
+        try:
+            shm = shared_memory.SharedMemory(create=True, size=x.nbytes)
+        except OSError:
+            return x
+        np.ndarray(x.shape, dtype=x.dtype, buffer=shm.buf)[...] = x
+
+        # ownership passes to the process loading the array, which unlinks it
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        shm.close()
+        return (np.ndarray, (shm.name, x.shape, x.dtype.str))
+
+    return x
+
+def _shm_load(x):
+    from multiprocessing import shared_memory
+
+    if not isinstance(x, tuple):
+        return x
+
+    kind, contents = x
+    if kind is np.ndarray:
+        name, shape, dtype = contents
+        shm = shared_memory.SharedMemory(name=name)
+        try:
+            return np.ndarray(shape, dtype=dtype, buffer=shm.buf).copy()
+        finally:
+            shm.close()
+            shm.unlink()
+
+    return kind(_shm_load(y) for y in contents)
+
+
 ###############################################################################
 # Activation Functions
 ###############################################################################
 
 ACT_DICT = {'LeakyReLU': LeakyReLU, 'PReLU': PReLU, 'ThresholdedReLU': ThresholdedReLU}
 
-def _get_act_layer(act):
+# NumPy implementations of the standard Keras activations
+NP_ACT_DICT = {
+    'linear': lambda x: x,
+    'relu': lambda x: np.maximum(x, 0),
+    'sigmoid': lambda x: 1/(1 + np.exp(-x)),
+    'tanh': np.tanh,
+    'softplus': lambda x: np.logaddexp(0, x),
+    'elu': lambda x: np.where(x > 0, x, np.expm1(x)),
+}
+
+def _get_act_layer(act, **kwargs):
 
     # handle case of act as a layer
     if isinstance(act, Layer):
@@ -361,7 +705,27 @@ def _get_act_layer(act):
 
     # handle case of act being a string and in ACT_DICT
     if isinstance(act, six.string_types) and act in ACT_DICT:
-        return ACT_DICT[act]()
+        return ACT_DICT[act](**kwargs)
 
     # default case of passing act into layer
-    return Activation(act)
+    return Activation(act, **kwargs)
+
+def _get_np_act(act_layer):
+
+    # handle advanced activation layers
+    if isinstance(act_layer, LeakyReLU):
+        alpha = float(act_layer.alpha)
+        return lambda x: np.where(x > 0, x, alpha*x)
+    if isinstance(act_layer, PReLU):
+        alphas = act_layer.get_weights()[0]
+        return lambda x: np.where(x > 0, x, alphas*x)
+    if isinstance(act_layer, ThresholdedReLU):
+        theta = float(act_layer.theta)
+        return lambda x: x*(x > theta)
+
+    # handle regular activation layers
+    name = getattr(getattr(act_layer, 'activation', None), '__name__', None)
+    if isinstance(act_layer, Activation) and name in NP_ACT_DICT:
+        return NP_ACT_DICT[name]
+
+    raise ValueError('no NumPy implementation for activation {}'.format(act_layer))
@@ -3,7 +3,7 @@ from __future__ import absolute_import, division, print_function
 from keras.layers import Conv2D, Dense, Flatten, Dropout, MaxPooling2D, SpatialDropout2D
 from keras.models import Sequential
 
-from energyflow.archs.archbase import NNBase
+from energyflow.archs.archbase import NNBase, _with_dtype_policy
 from energyflow.utils import iter_or_rep
 
 __all__ = ['CNN']
@@ -122,6 +122,7 @@ class CNN(NNBase):
 
         self._verify_empty_hps()
 
+    @_with_dtype_policy
     def _construct_model(self):
 
         # fresh model
@@ -147,7 +148,7 @@ class CNN(NNBase):
                 self.model.add(MaxPooling2D(pool_size=pool_size, name=self._proc_name('max_pool_'+str(i))))
 
             # add dropout layer if we have a non-zero dropout rate
-            if dropout > 0.:
+            if dropout > 0. and not self.inference_only:
                 d_layer = SpatialDropout2D if i < self.num_spatial2d_dropout else Dropout
                 self.model.add(d_layer(dropout, name=self._proc_name('dropout_'+str(i))))
                 num_dropout += 1
@@ -167,12 +168,12 @@ class CNN(NNBase):
             self._add_act(act)
 
             # add dropout layer if dropout is nonzero
-            if dropout > 0.:
+            if dropout > 0. and not self.inference_only:
                 self.model.add(Dropout(dropout, name=self._proc_name('dropout_'+str(i+num_dropout))))
 
         # output layer
-        self.model.add(Dense(self.output_dim, name=self._proc_name('output')))
-        self._add_act(self.output_act)
+        self.model.add(Dense(self.output_dim, name=self._proc_name('output'), **self._output_kwargs()))
+        self._add_act(self.output_act, **self._output_kwargs())
 
         # compile model
         self._compile_model()
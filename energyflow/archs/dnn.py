@@ -4,7 +4,7 @@ from keras.layers import Dense, Dropout
 from keras.models import Sequential
 from keras.regularizers import l2
 
-from energyflow.archs.archbase import NNBase
+from energyflow.archs.archbase import NNBase, _with_dtype_policy
 from energyflow.utils import iter_or_rep
 
 __all__ = ['DNN']
@@ -78,6 +78,7 @@ class DNN(NNBase):
 
         self._verify_empty_hps()
 
+    @_with_dtype_policy
     def _construct_model(self):
 
         # fresh model
@@ -100,15 +101,15 @@ class DNN(NNBase):
             self._add_act(act)
 
             # add dropout layer if nonzero
-            if dropout > 0.:
+            if dropout > 0. and not self.inference_only:
                 self.model.add(Dropout(dropout, name=self._proc_name('dropout_' + str(i))))
 
         if not looped:
             raise ValueError('need to specify at least one dense layer')
 
         # output layer
-        self.model.add(Dense(self.output_dim, name=self._proc_name('output')))
-        self._add_act(self.output_act)
+        self.model.add(Dense(self.output_dim, name=self._proc_name('output'), **self._output_kwargs()))
+        self._add_act(self.output_act, **self._output_kwargs())
 
         # compile model
         self._compile_model()
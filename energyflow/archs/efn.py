@@ -6,11 +6,11 @@ import numpy as np
 
 from keras import __version__ as __keras_version__
 from keras import backend as K
-from keras.layers import Dense, Dot, Dropout, Input, Lambda, TimeDistributed
+from keras.layers import Dense, Dot, Dropout, Input, Lambda
 from keras.models import Model
 from keras.regularizers import l2
 
-from energyflow.archs.archbase import NNBase, _get_act_layer
+from energyflow.archs.archbase import NNBase, _get_act_layer, _get_np_act, _with_dtype_policy
 from energyflow.utils import iter_or_rep
 
 __all__ = [
@@ -62,6 +62,10 @@ def construct_efn_weight_mask(input_tensor, mask_val=0., name=None):
 
     # define a function which maps the given mask_val to zero
     def efn_mask_func(X, mask_val=mask_val):
+
+        # entries equal to zero are already zero, so there is nothing to do
+        if mask_val == 0:
+            return X
     
         # map mask_val to zero and leave everything else alone    
         return X * K.cast(K.not_equal(X, mask_val), K.dtype(X))
@@ -104,24 +108,24 @@ def construct_distributed_dense(input_tensor, sizes, acts='relu', k_inits='he_un
     # iterate over specified layers
     for s, act, k_init, name, l2_reg in zip(sizes, acts, k_inits, names, l2_regs):
         
-        # define a dense layer that will be applied through time distributed
+        # define a dense layer, which acts on the last axis and is therefore
+        # applied to each particle independently
         kwargs = {} 
         if l2_reg > 0.:
             kwargs.update({'kernel_regularizer': l2(l2_reg), 'bias_regularizer': l2(l2_reg)})
-        d_layer = Dense(s, kernel_initializer=k_init, **kwargs)
+        d_layer = Dense(s, kernel_initializer=k_init, name=name, **kwargs)
 
         # get layers and append them to list
-        tdist_layer = TimeDistributed(d_layer, name=name)
         act_layer = _get_act_layer(act)
-        layers.extend([tdist_layer, act_layer])
+        layers.extend([d_layer, act_layer])
 
         # get tensors and append them to list
-        tensors.append(tdist_layer(tensors[-1]))
+        tensors.append(d_layer(tensors[-1]))
         tensors.append(act_layer(tensors[-1]))
 
     return layers, tensors
 
-def construct_latent(input_tensor, weight_tensor, dropout=0., name=None):
+def construct_latent(input_tensor, weight_tensor, dropout=0., noise_shape=None, name=None):
     """"""
 
     # lists of layers and tensors
@@ -131,7 +135,7 @@ def construct_latent(input_tensor, weight_tensor, dropout=0., name=None):
     # apply dropout if specified
     if dropout > 0.:
         dr_name = None if name is None else '{}_dropout'.format(name)
-        layers.append(Dropout(dropout, name=dr_name))
+        layers.append(Dropout(dropout, noise_shape=noise_shape, name=dr_name))
         tensors.append(layers[-1](tensors[-1]))
 
     return layers, tensors
@@ -230,6 +234,14 @@ class SymmetricPerParticleNN(NNBase):
             value of the latent observables on the inputs. See the [Keras
             Dropout layer](https://keras.io/layers/core/#dropout) for more 
             detail.
+        - **latent_noise_shape**=`None` : _tuple_ of _int_ or `None`
+            - The `noise_shape` of the latent dropout layer, i.e. the shape of
+            the binary dropout mask that is broadcast against the latent
+            observables, which have shape `(batch_size, Phi_sizes[-1])`. For
+            example, `(1, Phi_sizes[-1])` drops the same latent observables
+            for every event in a batch, which requires drawing far fewer random
+            numbers per training step. If `None`, every entry is dropped
+            independently.
         - **F_dropouts**=`0` (formerly `dense_dropouts`) : {_tuple_, _list_}
         of _float_
             - Dropout rates for the dense layers in the backend module $F$. 
@@ -272,6 +284,7 @@ class SymmetricPerParticleNN(NNBase):
 
         # regularizations
         self.latent_dropout = self._proc_arg('latent_dropout', default=0.)
+        self.latent_noise_shape = self._proc_arg('latent_noise_shape', default=None)
         self.F_dropouts = iter_or_rep(self._proc_arg('F_dropouts', default=0., 
                                                                    old='dense_dropouts'))
         self.Phi_l2_regs = iter_or_rep(self._proc_arg('Phi_l2_regs', default=0.))
@@ -282,6 +295,7 @@ class SymmetricPerParticleNN(NNBase):
 
         self._verify_empty_hps()
 
+    @_with_dtype_policy
     def _construct_model(self):
 
         # initialize dictionaries for holding indices of subnetworks
@@ -294,8 +308,8 @@ class SymmetricPerParticleNN(NNBase):
         self._construct_F()
 
         # get output layers
-        d_layer = Dense(self.output_dim, name=self._proc_name('output'))
-        act_layer = _get_act_layer(self.output_act)
+        d_layer = Dense(self.output_dim, name=self._proc_name('output'), **self._output_kwargs())
+        act_layer = _get_act_layer(self.output_act, **self._output_kwargs())
 
         # append output tensors
         self._tensors.append(d_layer(self.tensors[-1]))
@@ -343,9 +357,11 @@ class SymmetricPerParticleNN(NNBase):
         # determine begin inds
         layer_inds, tensor_inds = [len(self.layers)], [len(self.tensors)]
 
-        # construct latent tensors
+        # construct latent tensors, dropout is only needed for training
+        dropout = 0. if self.inference_only else self.latent_dropout
         latent_layers, latent_tensors = construct_latent(self._tensors[-1], self.weights, 
-                                                         dropout=self.latent_dropout, 
+                                                         dropout=dropout, 
+                                                         noise_shape=self.latent_noise_shape,
                                                          name=self._proc_name('sum'))
         
         # add layers and tensors to internal lists
@@ -369,10 +385,11 @@ class SymmetricPerParticleNN(NNBase):
         layer_inds, tensor_inds = [len(self.layers)], [len(self.tensors)]
 
 
-        # construct F
+        # construct F, dropout is only needed for training
+        dropouts = 0. if self.inference_only else self.F_dropouts
         F_layers, F_tensors = construct_dense(self.latent[-1], self.F_sizes,
                                               acts=self.F_acts, k_inits=self.F_k_inits, 
-                                              dropouts=self.F_dropouts, names=names,
+                                              dropouts=dropouts, names=names,
                                               l2_regs=self.F_l2_regs)
 
         # add layers and tensors to internal lists
@@ -387,6 +404,46 @@ class SymmetricPerParticleNN(NNBase):
         self._layer_inds['F'] = layer_inds
         self._tensor_inds['F'] = tensor_inds
 
+    # export_Phi()
+    def export_Phi(self):
+        r"""Extracts the weights of the $\Phi$ network into NumPy arrays and
+        returns a function which evaluates $\Phi$ as a chain of matrix
+        multiplications and activations. This avoids the overhead of calling
+        into Keras, which makes it well suited to analyses that evaluate the
+        per-particle network many times on modest amounts of data. The weights
+        are copied when this method is called, so subsequent training of the
+        model does not affect the returned function. Only activations with a
+        NumPy implementation are supported, namely `'linear'`, `'relu'`,
+        `'sigmoid'`, `'tanh'`, `'softplus'`, `'elu'`, and the `LeakyReLU`,
+        `PReLU`, and `ThresholdedReLU` layers.
+
+        **Returns**
+
+        - _function_
+            - A function which accepts an array of shape `(..., input_dim)`
+            and returns the values of the $\Phi$ network, an array of shape
+            `(..., Phi_sizes[-1])`.
+        """
+
+        # extract weights, biases, and activations of the Phi layers
+        Ws, bs, acts = [], [], []
+        begin, end = self._layer_inds['Phi']
+        for layer in self.layers[begin:end]:
+            if isinstance(layer, Dense):
+                W, b = layer.get_weights()
+                Ws.append(W)
+                bs.append(b)
+            else:
+                acts.append(_get_np_act(layer))
+
+        def Phi(X):
+            X = np.asarray(X)
+            for W, b, act in zip(Ws, bs, acts):
+                X = act(np.matmul(X, W) + b)
+            return X
+
+        return Phi
+
     @abstractproperty
     def inputs(self):
         pass
@@ -481,8 +538,8 @@ class EFN(SymmetricPerParticleNN):
 
         return self._weights
 
-    # eval_filters(patch, n=100, prune=True)
-    def eval_filters(self, patch, n=100, prune=True):
+    # eval_filters(patch, n=100, prune=True, batch_size=65536, use_numpy=False)
+    def eval_filters(self, patch, n=100, prune=True, batch_size=65536, use_numpy=False):
         """Evaluates the latent space filters of this model on a patch of the 
         two-dimensional geometric input space.
 
@@ -500,6 +557,13 @@ class EFN(SymmetricPerParticleNN):
         - **prune** : _bool_
             - Whether to remove filters that are all zero (which happens sometimes
             due to dying ReLUs).
+        - **batch_size** : _int_
+            - The maximum number of grid points passed through the $\Phi$
+            network at once. Large grids are evaluated in chunks of this size
+            in order to bound the memory used.
+        - **use_numpy** : _bool_
+            - Whether to evaluate the filters with the NumPy function returned
+            by [`export_Phi`](#export_phi) rather than by calling into Keras.
 
         **Returns**
 
@@ -528,22 +592,37 @@ class EFN(SymmetricPerParticleNN):
         # construct grid of inputs
         xs, ys = np.linspace(xmin, xmax, nx), np.linspace(ymin, ymax, ny)
         X, Y = np.meshgrid(xs, ys, indexing='ij')
-        XY = np.asarray([X, Y]).reshape((1, 2, nx*ny)).transpose((0, 2, 1))
+        XY = np.empty((1, nx*ny, 2), dtype=K.floatx())
+        XY[0,:,0], XY[0,:,1] = X.ravel(), Y.ravel()
 
-        # handle weirdness of Keras/tensorflow
-        old_keras = (keras_version_tuple <= (2, 2, 5))
         s = self.Phi_sizes[-1] if len(self.Phi_sizes) else self.input_dim
-        in_t, out_t = self.inputs[1], self._tensors[self._tensor_inds['latent'][0] - 1]
 
-        # construct function
-        kf = K.function([in_t] if old_keras else in_t, [out_t] if old_keras else out_t)
+        # get NumPy version of Phi if requested
+        if use_numpy:
+            Phi = self.export_Phi()
+
+        # construct Keras function once and reuse it for subsequent calls
+        else:
+
+            # handle weirdness of Keras/tensorflow
+            old_keras = (keras_version_tuple <= (2, 2, 5))
+            if not hasattr(self, '_filters_kf'):
+                in_t, out_t = self.inputs[1], self._tensors[self._tensor_inds['latent'][0] - 1]
+                self._filters_kf = K.function([in_t] if old_keras else in_t, 
+                                              [out_t] if old_keras else out_t)
+
+            def Phi(XY_chunk):
+                return self._filters_kf([XY_chunk] if old_keras else XY_chunk)[0]
 
-        # evaluate function
-        Z = kf([XY] if old_keras else XY)[0].reshape(nx, ny, s).transpose((2, 0, 1))
+        # evaluate function on chunks of the grid
+        Zs = []
+        for i in range(0, nx*ny, batch_size):
+            Zs.append(Phi(XY[:,i:i+batch_size]).reshape(-1, s))
+        Z = np.concatenate(Zs).reshape(nx, ny, s).transpose((2, 0, 1))
 
         # prune filters that are off
         if prune:
-            return X, Y, Z[[not (z == 0).all() for z in Z]]
+            return X, Y, Z[Z.any(axis=(1, 2))]
         
         return X, Y, Z
 
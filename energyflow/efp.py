@@ -18,9 +18,10 @@ import re
 import warnings
 
 import numpy as np
+from numpy.core.multiarray import c_einsum
 import six
 
-from energyflow.algorithms import VariableElimination, einsum_path, einsum
+from energyflow.algorithms import VariableElimination, einsum_path
 from energyflow.base import EFPBase
 from energyflow.efm import EFMSet, efp2efms
 from energyflow.measure import PF_MARKER
@@ -30,6 +31,49 @@ from energyflow.utils.graph_utils import *
 
 __all__ = ['EFP', 'EFPSet']
 
+###############################################################################
+# EFP helpers
+###############################################################################
+
+# contraction specifications shared by all EFPs with the same graph and options
+_EFM_EINPATHS, _EINSPECS = {}, {}
+
+# gets the einsum path for an EFM contraction, computing it only once per contraction
+def _efm_einpath(efm_einstr, efm_spec, np_optimize):
+    key = (efm_einstr, tuple(efm_spec), np_optimize)
+    if key not in _EFM_EINPATHS:
+        args = [np.empty([4]*sum(s)) for s in efm_spec]
+        _EFM_EINPATHS[key] = einsum_path(efm_einstr, *args, optimize=np_optimize)[0]
+    return _EFM_EINPATHS[key]
+
+# gets the variable elimination specification, computing it only once per simple graph
+def _einspecs(simple_graph, n, np_optimize):
+    key = (tuple(simple_graph), n, np_optimize)
+    if key not in _EINSPECS:
+        _EINSPECS[key] = VariableElimination(np_optimize).einspecs(simple_graph, n)
+    return _EINSPECS[key]
+
+# gets the sequence of pairwise contractions for a fixed einsum path, which depends
+# only on einstr since every index of an EFP or EFM contraction has the same size
+def _contraction_list(einstr, einpath):
+    args = [np.empty([2]*len(term)) for term in einstr.split('->')[0].split(',')]
+    return einsum_path(einstr, *args, optimize=einpath, einsum_call=True)[1]
+
+# carries out a contraction list without reparsing the einstr on every call
+def _contract(contraction_list, operands):
+    operands = list(operands)
+    for contraction in contraction_list:
+        tmp_operands = [operands.pop(x) for x in contraction[0]]
+        operands.append(c_einsum(contraction[2], *tmp_operands))
+    return operands[0]
+
+# makes a 1-d object array of graphs, which may have different numbers of edges
+def _graph_array(graphs):
+    arr = np.empty(len(graphs), dtype=object)
+    for i,graph in enumerate(graphs):
+        arr[i] = graph
+    return arr
+
 ###############################################################################
 # EFP
 ###############################################################################
@@ -78,6 +122,9 @@ class EFP(EFPBase):
         self._np_optimize = np_optimize
         self._weights = weights
 
+        # contraction lists are determined on first use
+        self._contractions = self._efm_contractions = None
+
         # generate our own information from the edges
         if efpset_args is not None:
             (self._einstr, self._einpath, self._spec, self._efm_einstr,
@@ -99,12 +146,11 @@ class EFP(EFPBase):
             # only store an EFMSet if this is an external EFP using EFMs
             if self.has_measure and self.use_efms:
                 self._efmset = EFMSet(self._efm_spec, subslicing=self.subslicing, no_measure=True)
-            args = [np.empty([4]*sum(s)) for s in self._efm_spec]
-            self._efm_einpath = einsum_path(self._efm_einstr, *args, optimize=np_optimize)[0]
+            self._efm_einpath = _efm_einpath(self._efm_einstr, self._efm_spec, np_optimize)
             
             # setup traditional VE computation
-            ve = VariableElimination(self.np_optimize)
-            (self._einstr, self._einpath, self._c) = ve.einspecs(self.simple_graph, self.n)
+            (self._einstr, self._einpath, self._c) = _einspecs(self.simple_graph, self.n, 
+                                                               self.np_optimize)
 
             # compute and store spec information
             vs = valencies(self.graph).values()
@@ -156,12 +202,16 @@ class EFP(EFPBase):
         self._weight_set = frozenset(self._weights)
 
     def _efp_compute(self, zs, thetas_dict):
+        if self._contractions is None:
+            self._contractions = _contraction_list(self.einstr, self.einpath)
         einsum_args = [thetas_dict[w] for w in self.weights] + self._n*[zs]
-        return einsum(self.einstr, *einsum_args, optimize=self.einpath)
+        return _contract(self._contractions, einsum_args)
 
     def _efm_compute(self, efms_dict):
+        if self._efm_contractions is None:
+            self._efm_contractions = _contraction_list(self.efm_einstr, self.efm_einpath)
         einsum_args = [efms_dict[sig] for sig in self.efm_spec]
-        return einsum(self.efm_einstr, *einsum_args, optimize=self.efm_einpath)
+        return _contract(self._efm_contractions, einsum_args)
 
     #===============
     # PUBLIC METHODS
@@ -446,7 +496,7 @@ class EFPSet(EFPBase):
             # get disc formulae and disc mask
             orig_disc_specs = np.asarray(gen['disc_specs'])
             disc_mask = self.sel(*args, specs=orig_disc_specs)
-            disc_formulae = np.asarray(gen['disc_formulae'])[disc_mask]
+            disc_formulae = [f for f,m in zip(gen['disc_formulae'], disc_mask) if m]
 
             # get connected specs and full specs
             orig_c_specs = np.asarray(gen['c_specs'])
@@ -491,7 +541,7 @@ class EFPSet(EFPBase):
 
     def _make_graphs(self, connected_graphs):
         disc_comps = [[connected_graphs[i] for i in col_inds] for col_inds in self._disc_col_inds]
-        return np.asarray(connected_graphs + [graph_union(*dc) for dc in disc_comps])
+        return _graph_array(connected_graphs + [graph_union(*dc) for dc in disc_comps])
 
     #===============
     # PUBLIC METHODS
@@ -702,7 +752,7 @@ class EFPSet(EFPBase):
         # if we haven't extracted the graphs, do it now
         if not hasattr(self, '_graphs'):
             if self._disc_col_inds is None:
-                self._graphs = np.asarray([efp.graph for efp in self.efps])
+                self._graphs = _graph_array([efp.graph for efp in self.efps])
             else:
                 self._graphs = self._make_graphs([efp.graph for efp in self.efps])
 
@@ -735,7 +785,7 @@ class EFPSet(EFPBase):
         # if we haven't extracted the simple graphs, do it now
         if not hasattr(self, '_simple_graphs'):
             if self._disc_col_inds is None:
-                self._simple_graphs = np.asarray([efp.simple_graph for efp in self.efps])
+                self._simple_graphs = _graph_array([efp.simple_graph for efp in self.efps])
             else:
                 self._simple_graphs = self._make_graphs([efp.simple_graph for efp in self.efps])
 
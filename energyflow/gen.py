@@ -1,7 +1,7 @@
 """Implementation of EFP/EFM Generator class."""
 from __future__ import absolute_import, division, print_function
 
-from collections import Counter
+from collections import Counter, defaultdict
 import gzip
 import itertools
 import json
@@ -26,6 +26,31 @@ __all__ = ['Generator']
 def none2inf(x):
     return np.inf if x is None else x
 
+# simple graphs with more automorphisms than this have their weightings compared
+# via canonical labelings rather than by enumerating the automorphisms
+MAX_AUTOMORPHISMS = 120
+
+# generates the distinct orderings of a sequence in lexicographic order (Knuth's
+# Algorithm L), which avoids producing all len(seq)! permutations when there are repeats
+def unique_permutations(seq):
+    a = sorted(seq)
+    while True:
+        yield tuple(a)
+
+        # find last position that can be increased
+        j = len(a) - 2
+        while j >= 0 and a[j] >= a[j+1]:
+            j -= 1
+        if j < 0:
+            return
+
+        # increase it by as little as possible and reset the tail
+        l = len(a) - 1
+        while a[j] >= a[l]:
+            l -= 1
+        a[j], a[l] = a[l], a[j]
+        a[j+1:] = a[:j:-1]
+
 ###############################################################################
 # Generator
 ###############################################################################
@@ -265,11 +290,14 @@ class PrimeGenerator(object):
         self.dmaxs = {(n,e): self.dmax for n in self.ns for e in self.esbyn[n]}
 
         # setup storage containers
-        quantities = ['simple_graphs_d', 'edges_d', 'chis_d', 'einpaths_d',
+        quantities = ['simple_graphs_d', 'edges_d', 'edge_masks_d', 'chis_d', 'einpaths_d',
                       'einstrs_d', 'weights_d']
         for q in quantities:
             setattr(self, q, {(n,e): [] for n in self.ns for e in self.esbyn[n]})
 
+        # canonical forms of the simple graphs, used to detect isomorphisms
+        self.canon_forms_d = {(n,e): set() for n in self.ns for e in self.esbyn[n]}
+
         # get simple connected graphs
         self._generate_simple()
         if verbose:
@@ -299,8 +327,13 @@ class PrimeGenerator(object):
 
         self.base_edges = {n: list(itertools.combinations(range(n), 2)) for n in self.ns}
 
+        # each possible edge is assigned a bit, so sets of edges can be stored as ints
+        self.edge_bits = {n: {edge: 1 << i for i,edge in enumerate(self.base_edges[n])} 
+                          for n in self.ns}
+        self.full_edge_masks = {n: (1 << len(self.base_edges[n])) - 1 for n in self.ns}
+
         if self.nmax >= 1:
-            self._add_if_new(igraph.Graph.Full(1, directed=False), (1,0))
+            self._add_if_new([], (1,0))
 
         # iterate over all combinations of n>1 and d
         for n in self.ns[1:]:
@@ -310,55 +343,58 @@ class PrimeGenerator(object):
                 if e-1 in self.esbyn[n-1]:
 
                     # iterate over all graphs with n-1, e-1
-                    for seed_graph in self.simple_graphs_d[(n-1,e-1)]:
+                    for seed_edges in self.edges_d[(n-1,e-1)]:
 
                         # iterate over vertices to attach to
                         for v in range(n-1):
-                            new_graph = seed_graph.copy()
-                            new_graph.add_vertices(1)
-                            new_graph.add_edges([(v,n-1)])
-                            self._add_if_new(new_graph, (n,e))
+                            self._add_if_new(seed_edges + [(v,n-1)], (n,e))
 
                 # consider adding new edge to existing set of vertices
                 if e-1 in self.esbyn[n]:
 
                     # iterate over all graphs with n, d-1
-                    for seed_graph, seed_edges in zip(self.simple_graphs_d[(n,e-1)], 
-                                                      self.edges_d[(n,e-1)]):
+                    for seed_edges, seed_mask in zip(self.edges_d[(n,e-1)], 
+                                                     self.edge_masks_d[(n,e-1)]):
 
                         # iterate over edges that don't exist in graph
-                        for new_edge in self._edge_filter(n, seed_edges):
-                            new_graph = seed_graph.copy()
-                            new_graph.add_edges([new_edge])
-                            self._add_if_new(new_graph, (n,e))
+                        for new_edge in self._edge_filter(n, seed_mask):
+                            self._add_if_new(seed_edges + [new_edge], (n,e))
 
     # adds simple graph if it is non-isomorphic to existing graphs and has a valid metric
-    def _add_if_new(self, new_graph, ne):
+    def _add_if_new(self, new_edges, ne):
+
+        n, canon_forms = ne[0], self.canon_forms_d[ne]
 
-        # check for isomorphism with existing graphs
-        for graph in self.simple_graphs_d[ne]:
-            if new_graph.isomorphic(graph): 
-                return
+        # check for isomorphism with existing graphs via their canonical forms
+        new_graph = igraph.Graph(n=n, edges=new_edges, directed=False)
+        canon_graph = new_graph.permute_vertices(new_graph.canonical_permutation())
+        canon_form = tuple(sorted(canon_graph.get_edgelist()))
+        if canon_form in canon_forms:
+            return
 
         # check that ve complexity for this graph is valid
-        new_edges = new_graph.get_edgelist()
-        einstr, einpath, chi = self.ve.einspecs(new_edges, ne[0])
+        einstr, einpath, chi = self.ve.einspecs(new_edges, n)
         if chi > self.cmax: 
             return
         
         # append graph and ve complexity to containers
+        canon_forms.add(canon_form)
         self.simple_graphs_d[ne].append(new_graph)
         self.edges_d[ne].append(new_edges)
+        edge_bits = self.edge_bits[n]
+        self.edge_masks_d[ne].append(sum(edge_bits[edge] for edge in new_edges))
         self.chis_d[ne].append(chi)
 
         self.einstrs_d[ne].append(einstr)
         self.einpaths_d[ne].append(einpath)
 
-    # generator for edges not already in list
-    def _edge_filter(self, n, edges):
-        for edge in self.base_edges[n]:
-            if edge not in edges:
-                yield edge
+    # generator for edges not already in the bitmask, in the order of base_edges
+    def _edge_filter(self, n, edge_mask):
+        missing = self.full_edge_masks[n] & ~edge_mask
+        while missing:
+            bit = missing & -missing
+            yield self.base_edges[n][bit.bit_length() - 1]
+            missing ^= bit
 
     # generates non-isomorphic graph weights subject to constraints
     def _generate_weights(self):
@@ -367,76 +403,132 @@ class PrimeGenerator(object):
         if (2,1) in self.weights_d:
             self.weights_d[(2,1)].append([(d,) for d in range(1, self.dmaxs[(2,1)]+1)])
 
-        # get ordered integer partitions of d of length e for relevant values
-        parts = {}
+        # get ordered integer partitions of d of length e for relevant values, as tuples
+        # to be used as weights and as compact arrays shared by all graphs with this e
+        parts, part_arrs, places = {}, {}, {}
         for n in self.ns[2:]:
             for e in self.esbyn[n]:
                 for d in range(e, self.dmaxs[(n,e)]+1):
                     if (d,e) not in parts:
                         parts[(d,e)] = list(int_partition_ordered(d, e))
+                        dtype = np.int8 if d <= np.iinfo(np.int8).max else int
+                        part_arrs[(d,e)] = np.asarray(parts[(d,e)], dtype=dtype)
+
+                        # place values of a base d+1 encoding that preserves lexicographic order
+                        dtype = int if (d+1)**e <= np.iinfo(int).max else object
+                        places[(d,e)] = np.asarray([(d+1)**i for i in range(e-1,-1,-1)], dtype=dtype)
+
+        # bind values used in the innermost loops to local names
+        vmax, check_vmax = self.vmax, self.vmax < self.dmax
 
         # iterate over the rest of ns
         for n in self.ns[2:]:
 
             # iterate over es for which there are simple graphs
             for e in self.esbyn[n]:
+                ds = range(e, self.dmaxs[(n,e)]+1)
 
                 # iterate over simple graphs
-                for graph in self.simple_graphs_d[(n,e)]:
+                for edges in self.edges_d[(n,e)]:
                     weightings = []
 
+                    # automorphisms of the simple graph, computed once, as permutations of edges,
+                    # unless there are so many that canonical labelings are cheaper
+                    graph = igraph.Graph(n=n, edges=edges)
+                    use_auts = graph.count_automorphisms() <= MAX_AUTOMORPHISMS
+                    if use_auts:
+                        edge_inds = {edge: i for i,edge in enumerate(edges)}
+                        edge_perms = np.asarray([[edge_inds[tuple(sorted((aut[u], aut[v])))] 
+                                                  for u,v in edges] 
+                                                 for aut in graph.get_automorphisms_vf2()])
+
+                    # otherwise subdivide each edge with a vertex that will be colored by its weight
+                    else:
+                        sub_edges = [(u,n+i) for i,(u,v) in enumerate(edges)]
+                        sub_edges += [(v,n+i) for i,(u,v) in enumerate(edges)]
+                        sub_graph = igraph.Graph(n=n+e, edges=sub_edges, directed=False)
+                        sub_vs = sub_graph.vs
+                        canonical_permutation = sub_graph.canonical_permutation
+                        permute_vertices = sub_graph.permute_vertices
+                        vertex_colors = [0]*n
+
+                    # edge-vertex incidence matrix, such that weights times it are valencies
+                    incidence = np.zeros((e, n), dtype=int)
+                    for i,edge in enumerate(edges):
+                        incidence[i,edge] = 1
+
                     # iterate over valid d for this graph
-                    for d in range(e, self.dmaxs[(n,e)]+1):
-
-                        # iterate over int partitions
-                        for part in parts[(d,e)]:
-
-                            # check that maximum valency is not exceeded 
-                            if (self.vmax < self.dmax and 
-                                max(graph.strength(weights=part)) > self.vmax):
-                                continue
-
-                            # check if isomorphic to existing
-                            iso = False
-                            for weighting in weightings:
-                                if graph.isomorphic_vf2(other=graph, 
-                                                        edge_color1=weighting, 
-                                                        edge_color2=part): 
-                                    iso = True
-                                    break
-                            if not iso: 
+                    for d in ds:
+
+                        # check that maximum valency is not exceeded for all partitions at once
+                        d_part_arr = part_arrs[(d,e)]
+                        if check_vmax:
+                            strengths = d_part_arr.dot(incidence)
+                            inds = np.nonzero(np.max(strengths, axis=1) <= vmax)[0]
+                        else:
+                            inds = np.arange(len(d_part_arr))
+
+                        d_parts = parts[(d,e)]
+
+                        # canonical form of each partition is its smallest image under the
+                        # automorphisms, keep the first partition having each canonical form
+                        if use_auts:
+                            canon_forms = d_part_arr[inds][:,edge_perms].dot(places[(d,e)])
+                            firsts = np.unique(np.min(canon_forms, axis=1), return_index=True)[1]
+                            weightings.extend(d_parts[i] for i in inds[np.sort(firsts)])
+                            continue
+
+                        # check if isomorphic to existing via canonical forms
+                        canon_forms = set()
+                        for i in inds:
+                            part = d_parts[i]
+                            sub_vs['color'] = vertex_colors + list(part)
+                            canon_graph = permute_vertices(canonical_permutation(color='color'))
+                            canon_form = (tuple(sorted(canon_graph.get_edgelist())), 
+                                          tuple(canon_graph.vs['color']))
+                            if canon_form not in canon_forms:
+                                canon_forms.add(canon_form)
                                 weightings.append(part)
                     self.weights_d[(n,e)].append(weightings)
 
     def _flatten_structures(self):
-        c_specs, self.edges, self.weights, self.einstrs, self.einpaths = [], [], [], [], []
-        ks = {}
+        self.edges, self.weights, self.einstrs, self.einpaths = [], [], [], []
+        ks = defaultdict(int)
+
+        # the number of connected graphs is known, so c_specs is filled in place
+        nes = sorted(self.edges_d.keys())
+        num_graphs = 1 + sum(len(ws) for ne in nes for ws in self.weights_d[ne])
+        self.c_specs = np.empty((num_graphs, len(self.cols)), dtype=int)
 
         # handle n=1 case specially
-        c_specs.append([1,0,0,0,0,1,1,0])
+        self.c_specs[0] = [1,0,0,0,0,1,1,0]
         self.edges.append(())
         self.weights.append(())
         self.einstrs.append(self.einstrs_d[(1,0)][0])
         self.einpaths.append(self.einpaths_d[(1,0)][0])
 
-        for ne in sorted(self.edges_d.keys()):
+        row = 1
+        for ne in nes:
             n, e = ne
             z = zip(self.edges_d[ne], self.weights_d[ne], self.chis_d[ne],
                     self.einstrs_d[ne], self.einpaths_d[ne])
             for edgs, ws, c, es, ep in z:
                 for w in ws:
                     d = sum(w)
-                    k = ks.setdefault((n,d), 0)
-                    ks[(n,d)] += 1
-                    vs = valencies(EFP(edgs, weights=w).graph).values()
+                    k = ks[(n,d)]
+                    ks[(n,d)] = k + 1
+
+                    # valencies of the multigraph, without constructing a full EFP
+                    vs = valencies([edge for edge,m in zip(edgs, w) for i in range(m)]).values()
                     v = max(vs)
                     h = Counter(vs)[1]
-                    c_specs.append([n, e, d, v, k, c, 1, h])
+                    self.c_specs[row] = [n, e, d, v, k, c, 1, h]
+                    row += 1
+
                     self.edges.append(edgs)
                     self.weights.append(w)
                     self.einstrs.append(es)
                     self.einpaths.append(ep)
-        self.c_specs = np.asarray(c_specs)
 
     def _generate_efms(self):
         self.efm_einstrs, self.efm_specs, self.efm_einpaths = [], [], []
@@ -467,12 +559,16 @@ class CompositeGenerator(object):
         self.ns = sorted(self.comp_dmaxs.keys())
         self.nmax_avail = np.max(self.c_specs[:,self.n_ind]) if len(self.c_specs) else 0
 
-        self.ks, self.ndk2i = {}, {}
-        for i,spec in enumerate(self.c_specs):
-            n, d, k = spec[[self.n_ind, self.d_ind, self.k_ind]]
-            self.ks.setdefault((n,d), 0)
-            self.ks[(n,d)] += 1
-            self.ndk2i[(n,d,k)] = i
+        # dense lookup of the row of c_specs for each (n,d,k), -1 if there is none
+        nmax, dmax, kmax = (np.max(self.c_specs[:,[self.n_ind, self.d_ind, self.k_ind]], axis=0) 
+                            if len(self.c_specs) else (0, 0, 0))
+        self.ndk2i = np.full((nmax+1, dmax+1, kmax+1), -1, dtype=int)
+
+        ns, ds, ks = self.c_specs[:,[self.n_ind, self.d_ind, self.k_ind]].T
+        self.ndk2i[ns,ds,ks] = np.arange(len(self.c_specs))
+
+        # number of connected graphs for each (n,d)
+        self.ks = dict(Counter(zip(ns.tolist(), ds.tolist())))
 
         self._generate_disconnected()
 
@@ -484,6 +580,9 @@ class CompositeGenerator(object):
         
         disc_formulae, disc_specs = [], []
 
+        # unordered integer partitions of each d, grouped by length
+        d_parts_d = {}
+
         for n in self.ns:
 
             # partitions with no 1s, no numbers > self.nmax_avail, and not the trivial partition
@@ -494,12 +593,18 @@ class CompositeGenerator(object):
             # iterate over all ds
             for d in range(int((n-1)/2)+1, self.comp_dmaxs[n]+1):
 
+                # partitions of d only need to be computed once
+                if d not in d_parts_d:
+                    d_parts_d[d] = {}
+                    for x in int_partition_unordered(d):
+                        d_parts_d[d].setdefault(len(x), []).append(x)
+
                 # iterate over all n_parts
                 for n_part in n_parts:
                     n_part_len = len(n_part)
 
                     # get d_parts of the right length
-                    d_parts = [x for x in int_partition_unordered(d) if len(x) == n_part_len]
+                    d_parts = d_parts_d[d].get(n_part_len, [])
 
                     # ensure that we found some
                     if len(d_parts) == 0: continue
@@ -507,8 +612,9 @@ class CompositeGenerator(object):
                     # usage of set and sorting is important to avoid duplicates
                     specs = set()
 
-                    # iterate over all orderings of the n_part
-                    for n_part_ord in set(itertools.permutations(n_part)):
+                    # iterate over all orderings of the n_part, as a set built in the same order
+                    # as from itertools.permutations so that the order of the graphs is unchanged
+                    for n_part_ord in set(unique_permutations(n_part)):
 
                         # iterate over all d_parts
                         for d_part in d_parts:
@@ -527,38 +633,40 @@ class CompositeGenerator(object):
 
                     # iterate over all specs that we found
                     for spec in specs:
+                        nns, dds = zip(*spec)
+                        spec_ks = [self.ks[factor] for factor in spec]
+
+                        # all possible formula implementations with the different ndk, 
+                        # in the same order as itertools.product over the ks of the factors
+                        kspecs = np.indices(spec_ks).reshape(len(spec), -1).T
+                        inds = self.ndk2i[nns, dds, kspecs]
+
+                        # combine the specs of the factors of each formula at once
+                        factor_specs = self.c_specs[inds]
+                        new_specs = np.zeros((len(kspecs), self.c_specs.shape[1]), dtype=int)
+                        new_specs[:,self.n_ind] = n
+                        new_specs[:,self.e_ind] = np.sum(factor_specs[:,:,self.e_ind], axis=1)
+                        new_specs[:,self.d_ind] = d
+                        new_specs[:,self.v_ind] = np.max(factor_specs[:,:,self.v_ind], axis=1)
+                        new_specs[:,self.c_ind] = np.max(factor_specs[:,:,self.c_ind], axis=1)
+                        new_specs[:,self.p_ind] = len(spec)
+                        new_specs[:,self.h_ind] = np.sum(factor_specs[:,:,self.h_ind], axis=1)
 
                         # keep track of how many we added
                         kcount = 0 if (n,d) not in self.ks else self.ks[(n,d)]
+                        new_specs[:,self.k_ind] = kcount + np.arange(len(kspecs))
 
-                        # iterate over all possible formula implementations with the different ndk
-                        for kspec in itertools.product(*[range(self.ks[factor]) for factor in spec]):
-
-                            # iterate over factors
-                            formula = []
-                            cmax = e = vmax = h = 0 
-                            for (nn,dd),kk in zip(spec,kspec):
-
-                                # add (n,d,k) of factor to formula
-                                ndk = (nn,dd,kk)
-                                formula.append(ndk)
-
-                                # select original simple graph
-                                ind = self.ndk2i[ndk]
-                                cmax = max(cmax, self.c_specs[ind, self.c_ind])
-                                e += self.c_specs[ind, self.e_ind]
-                                vmax = max(vmax, self.c_specs[ind, self.v_ind])
-                                h += self.c_specs[ind, self.h_ind]
-
-                            # append to stored array
-                            disc_formulae.append(tuple(sorted(formula)))
-                            disc_specs.append([n, e, d, vmax, kcount, cmax, len(kspec), h])
-                            kcount += 1
+                        # append to stored arrays
+                        disc_formulae.extend(tuple(sorted(zip(nns, dds, kspec))) 
+                                             for kspec in kspecs.tolist())
+                        disc_specs.extend(new_specs.tolist())
 
         # ensure unique formulae (deals with possible degeneracy in selection of factors)
-        disc_form_set = set()
-        mask = [not(form in disc_form_set or disc_form_set.add(form)) for form in disc_formulae]
-
-        # store as numpy arrays
-        self.disc_formulae = np.asarray(disc_formulae)[mask]
-        self.disc_specs = np.asarray(disc_specs)[mask]
\ No newline at end of file
+        first_inds = {}
+        keep_inds = [i for i,form in enumerate(disc_formulae) if first_inds.setdefault(form, i) == i]
+
+        # store as numpy arrays, formulae can have different numbers of factors
+        self.disc_formulae = np.empty(len(keep_inds), dtype=object)
+        for j,i in enumerate(keep_inds):
+            self.disc_formulae[j] = disc_formulae[i]
+        self.disc_specs = np.asarray([disc_specs[i] for i in keep_inds])
\ No newline at end of file
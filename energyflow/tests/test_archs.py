@@ -1,5 +1,7 @@
 from __future__ import absolute_import, division
 
+import warnings
+
 import numpy as np
 import pytest
 
@@ -85,11 +87,13 @@ def test_PFN_required(input_dim, Phi_sizes, F_sizes):
 
 @pytest.mark.arch
 @pytest.mark.archbase
+@pytest.mark.parametrize('async_checkpoint', [True, False])
 @pytest.mark.parametrize('modelcheck_opts', [{}, {'save_best_only': False}])
 @pytest.mark.parametrize('save_weights_only', [True, False])
 @pytest.mark.parametrize('save_while_training', [True, False])
 @pytest.mark.parametrize('model_path', ['', 'efn_test_model.h5'])
-def test_EFN_modelcheck(model_path, save_while_training, save_weights_only, modelcheck_opts):
+def test_EFN_modelcheck(model_path, save_while_training, save_weights_only, modelcheck_opts,
+                        async_checkpoint):
     n, m = 50, 10
     X_train = [np.random.rand(n, m), np.random.rand(n, m, 2)]
     Y_train = np.random.rand(n, 2)
@@ -97,9 +101,15 @@ def test_EFN_modelcheck(model_path, save_while_training, save_weights_only, mode
     Y_val = np.random.rand(n//10, 2)
     efn = archs.EFN(input_dim=2, Phi_sizes=[10], F_sizes=[10], summary=False, filepath=model_path, 
                     save_while_training=save_while_training, save_weights_only=save_weights_only,
-                    modelcheck_opts=modelcheck_opts)
+                    modelcheck_opts=modelcheck_opts, async_checkpoint=async_checkpoint)
     hist = efn.fit(X_train, Y_train, epochs=2, batch_size=10, validation_data=[X_val, Y_val])
 
+    # check that the saved weights are those of the final epoch
+    if model_path and save_weights_only and modelcheck_opts.get('save_best_only') is False:
+        efn2 = archs.EFN(input_dim=2, Phi_sizes=[10], F_sizes=[10], summary=False)
+        efn2.model.load_weights(model_path)
+        assert epsilon_diff(efn.predict(X_val), efn2.predict(X_val), 10**-6)
+
 @pytest.mark.arch
 @pytest.mark.masking
 @pytest.mark.efn
@@ -146,3 +156,225 @@ def test_PFN_masking(mask_val):
     kf = K.function(inputs=pfn.inputs, outputs=pfn.latent)
     pure_mask = kf([0*X_test + mask_val])[0]
     assert epsilon_diff(pure_mask, 0, 10**-15)
+
+@pytest.mark.arch
+@pytest.mark.archbase
+@pytest.mark.parametrize('jit_compile', [True, False])
+def test_EFN_jit_compile(jit_compile):
+    n, m = 50, 10
+    X_train = [np.random.rand(n, m), np.random.rand(n, m, 2)]
+    Y_train = np.random.rand(n, 2)
+    efn = archs.EFN(input_dim=2, Phi_sizes=[10], F_sizes=[10], summary=False, jit_compile=jit_compile)
+    assert bool(efn.model.jit_compile) == jit_compile
+    efn.fit(X_train, Y_train, epochs=1, batch_size=10)
+
+    # jit_compile may also be given in compile_opts, which takes precedence
+    with warnings.catch_warnings(record=True) as ws:
+        warnings.simplefilter('always')
+        efn = archs.EFN(input_dim=2, Phi_sizes=[10], F_sizes=[10], summary=False, 
+                        jit_compile=True, compile_opts={'jit_compile': jit_compile})
+    assert bool(efn.model.jit_compile) == jit_compile
+    assert not any('jit_compile' in str(w.message) for w in ws)
+
+@pytest.mark.arch
+@pytest.mark.efn
+@pytest.mark.parametrize('batch_size', [7, 65536])
+@pytest.mark.parametrize('prune', [True, False])
+@pytest.mark.parametrize('n', [10, (10, 15)])
+def test_EFN_eval_filters(n, prune, batch_size):
+    efn = archs.EFN(input_dim=2, Phi_sizes=[10, 10], F_sizes=[10], summary=False)
+    X, Y, Z = efn.eval_filters(1.0, n=n, prune=prune, batch_size=batch_size)
+    nx, ny = (n, n) if isinstance(n, int) else n
+    assert X.shape == Y.shape == (nx, ny)
+    assert Z.shape[1:] == (nx, ny)
+    if prune:
+        assert np.all(np.any(Z != 0, axis=(1, 2)))
+    else:
+        assert len(Z) == 10
+
+@pytest.mark.arch
+@pytest.mark.efn
+def test_EFN_eval_filters_batching():
+    efn = archs.EFN(input_dim=2, Phi_sizes=[10, 10], F_sizes=[10], summary=False)
+    Z = efn.eval_filters([-1, -2, 1, 2], n=(20, 30), prune=False)[2]
+    Z_batched = efn.eval_filters([-1, -2, 1, 2], n=(20, 30), prune=False, batch_size=17)[2]
+    assert epsilon_diff(Z, Z_batched, 10**-6)
+
+@pytest.mark.arch
+@pytest.mark.efn
+@pytest.mark.parametrize('Phi_acts', ['relu', 'tanh', 'softsign'])
+def test_EFN_eval_filters_numpy(Phi_acts):
+    efn = archs.EFN(input_dim=2, Phi_sizes=[10, 10], F_sizes=[10], Phi_acts=Phi_acts, summary=False)
+    Z_keras = efn.eval_filters(1.0, n=(20, 30), prune=False)[2]
+    if Phi_acts == 'softsign':
+        with pytest.raises(ValueError):
+            efn.eval_filters(1.0, n=(20, 30), use_numpy=True)
+    else:
+        Z_numpy = efn.eval_filters(1.0, n=(20, 30), prune=False, use_numpy=True, batch_size=17)[2]
+        assert epsilon_diff(Z_keras, Z_numpy, 10**-5)
+
+@pytest.mark.arch
+@pytest.mark.archbase
+def test_proc_arg():
+    with pytest.warns(FutureWarning):
+        efn = archs.EFN(input_dim=2, ppm_sizes=[10], F_sizes=[10], summary=False)
+    assert efn.Phi_sizes == [10]
+
+    with pytest.raises(KeyError):
+        archs.EFN(input_dim=2, F_sizes=[10], summary=False)
+
+    with pytest.raises(ValueError):
+        archs.EFN(input_dim=2, Phi_sizes=[10], F_sizes=[10], summary=False, bad_hp=1)
+
+@pytest.mark.arch
+@pytest.mark.parametrize('Phi_acts', ['relu', 'tanh', 'LeakyReLU', ['elu', 'sigmoid']])
+@pytest.mark.parametrize('Phi_sizes', [[], [10], [10, 8]])
+@pytest.mark.parametrize('model', ['EFN', 'PFN'])
+def test_export_Phi(model, Phi_sizes, Phi_acts):
+    n, m, input_dim = 20, 10, 3
+    nn = getattr(archs, model)(input_dim=input_dim, Phi_sizes=Phi_sizes, F_sizes=[10], 
+                               Phi_acts=Phi_acts, summary=False)
+    X = np.random.rand(n, m, input_dim)
+    kf = K.function(inputs=nn.inputs[-1], outputs=nn.Phi[-1])
+    assert epsilon_diff(kf(X), nn.export_Phi()(X), 10**-5)
+
+@pytest.mark.arch
+@pytest.mark.parametrize('shape', [(3,), (20, 3), (20, 10, 3), (5, 4, 10, 3)])
+def test_export_Phi_shapes(shape):
+    efn = archs.EFN(input_dim=3, Phi_sizes=[10, 8], F_sizes=[10], summary=False)
+    Phi = efn.export_Phi()
+    X = np.random.rand(*shape)
+    Phi_X = Phi(X)
+    assert Phi_X.shape == shape[:-1] + (8,)
+    assert epsilon_diff(Phi_X.reshape(-1, 8), Phi(X.reshape(-1, 3)), 10**-12)
+
+@pytest.mark.arch
+@pytest.mark.archbase
+@pytest.mark.parametrize('dtype_policy', [None, 'mixed_float16', 'mixed_bfloat16'])
+@pytest.mark.parametrize('model', ['EFN', 'PFN', 'DNN'])
+def test_dtype_policy(model, dtype_policy):
+    mixed_precision = pytest.importorskip('keras.mixed_precision')
+    n, m, input_dim = 50, 10, 2
+    if model == 'DNN':
+        X_train = np.random.rand(n, input_dim)
+        nn = archs.DNN(input_dim=input_dim, dense_sizes=[10], summary=False, dtype_policy=dtype_policy)
+    else:
+        X_train = np.random.rand(n, m, input_dim)
+        if model == 'EFN':
+            X_train = [np.random.rand(n, m), X_train]
+        nn = getattr(archs, model)(input_dim=input_dim, Phi_sizes=[10], F_sizes=[10], 
+                                   summary=False, dtype_policy=dtype_policy)
+    nn.fit(X_train, np.random.rand(n, 2), epochs=1, batch_size=10)
+    assert nn.predict(X_train).dtype == np.float32
+    assert mixed_precision.global_policy().name == 'float32'
+    if dtype_policy is not None:
+        assert nn.model.layers[-3].dtype_policy.name == dtype_policy
+
+@pytest.mark.arch
+@pytest.mark.archbase
+@pytest.mark.parametrize('workers', [1, 2])
+@pytest.mark.parametrize('shuffle', [True, False])
+def test_shared_memory(shuffle, workers):
+    pytest.importorskip('multiprocessing.shared_memory')
+    from keras.utils import Sequence
+    from energyflow.archs.archbase import _shared_memory_generator
+
+    class EFNSequence(Sequence):
+        def __init__(self, n, m, batch_size):
+            self.X = [np.random.rand(n, m), np.random.rand(n, m, 2)]
+            self.Y = np.random.rand(n, 2)
+            self.batch_size = batch_size
+        def __len__(self):
+            return int(np.ceil(len(self.Y)/self.batch_size))
+        def __getitem__(self, i):
+            s = slice(i*self.batch_size, (i+1)*self.batch_size)
+            return [X[s] for X in self.X], self.Y[s]
+
+    seq = EFNSequence(50, 10, 10)
+    batches = list(_shared_memory_generator(seq, 2, shuffle=shuffle, workers=workers))
+    assert len(batches) == 2*len(seq)
+    if not shuffle:
+        for i, (X, Y) in enumerate(batches[:len(seq)]):
+            assert np.all(Y == seq[i][1]) and np.all(X[1] == seq[i][0][1])
+
+    efn = archs.EFN(input_dim=2, Phi_sizes=[10], F_sizes=[10], summary=False, shared_memory=True)
+    hist = efn.fit(seq, epochs=2, workers=workers, shuffle=shuffle)
+    assert len(hist.history['loss']) == 2
+
+    # a smaller steps_per_epoch is honored for every epoch
+    batches = list(_shared_memory_generator(seq, 2, steps=3, shuffle=shuffle, workers=workers))
+    assert len(batches) == 6
+    hist = efn.fit(seq, epochs=2, steps_per_epoch=3, workers=workers, shuffle=shuffle)
+    assert len(hist.history['loss']) == 2
+
+    with pytest.raises(ValueError):
+        efn.fit(seq, None, None, 2)
+    with pytest.raises(ValueError):
+        efn.fit(seq, epochs=2, steps_per_epoch=len(seq) + 1)
+
+@pytest.mark.arch
+@pytest.mark.archbase
+@pytest.mark.parametrize('model', ['EFN', 'PFN'])
+def test_inference_only(model):
+    n, m, input_dim = 50, 10, 2
+    X = np.random.rand(n, m, input_dim)
+    if model == 'EFN':
+        X = [np.random.rand(n, m), X]
+    hps = {'input_dim': input_dim, 'Phi_sizes': [10], 'F_sizes': [10, 10], 'summary': False,
+           'latent_dropout': 0.1, 'F_dropouts': 0.2}
+    nn = getattr(archs, model)(hps)
+    nn.fit(X, np.random.rand(n, 2), epochs=1, batch_size=10)
+
+    nn_inf = getattr(archs, model)(hps, inference_only=True)
+    assert len(nn_inf.layers) < len(nn.layers)
+    assert not any('dropout' in layer.name for layer in nn_inf.model.layers)
+    assert nn_inf.model.optimizer is None
+
+    nn_inf.model.set_weights(nn.model.get_weights())
+    assert epsilon_diff(nn.predict(X), nn_inf.predict(X), 10**-6)
+
+@pytest.mark.arch
+@pytest.mark.efn
+@pytest.mark.parametrize('latent_noise_shape', [None, (1, 10), (None, 1)])
+def test_EFN_latent_noise_shape(latent_noise_shape):
+    n, m = 50, 10
+    X_train = [np.random.rand(n, m), np.random.rand(n, m, 2)]
+    Y_train = np.random.rand(n, 2)
+    efn = archs.EFN(input_dim=2, Phi_sizes=[10], F_sizes=[10], summary=False, 
+                    latent_dropout=0.5, latent_noise_shape=latent_noise_shape)
+    efn.fit(X_train, Y_train, epochs=1, batch_size=10)
+
+    dropped = np.asarray(efn.model.get_layer('sum_dropout')(np.ones((n, 10)), training=True))
+    if latent_noise_shape == (1, 10):
+        assert np.all(dropped == dropped[0])
+    elif latent_noise_shape == (None, 1):
+        assert np.all(dropped == dropped[:,:1])
+
+@pytest.mark.arch
+@pytest.mark.archbase
+@pytest.mark.parametrize('optimizer', ['adam', 'Adam', 'sgd'])
+def test_optimizer_opts(optimizer):
+    from keras import optimizers
+    n, input_dim = 50, 10
+    dnn = archs.DNN(input_dim=input_dim, dense_sizes=[10], summary=False, optimizer=optimizer,
+                    optimizer_opts={'learning_rate': 0.01})
+    assert isinstance(dnn.optimizer, type(optimizers.get(optimizer)))
+    assert np.isclose(float(dnn.model.optimizer.learning_rate), 0.01)
+    dnn.fit(np.random.rand(n, input_dim), np.random.rand(n, 2), epochs=1, batch_size=10)
+
+    with pytest.raises(ValueError):
+        archs.DNN(input_dim=input_dim, dense_sizes=[10], summary=False, 
+                  optimizer=optimizers.get(optimizer), optimizer_opts={'learning_rate': 0.01})
+
+    # optimizer classes are constructed with or without options
+    opt_class = type(optimizers.get(optimizer))
+    for optimizer_opts in [{}, {'learning_rate': 0.01}]:
+        dnn = archs.DNN(input_dim=input_dim, dense_sizes=[10], summary=False, 
+                        optimizer=opt_class, optimizer_opts=optimizer_opts)
+        assert isinstance(dnn.optimizer, opt_class)
+    assert np.isclose(float(dnn.model.optimizer.learning_rate), 0.01)
+
+    # no optimizer is constructed for inference
+    dnn = archs.DNN(input_dim=input_dim, dense_sizes=[10], summary=False, optimizer=opt_class,
+                    optimizer_opts={'learning_rate': 0.01}, inference_only=True)
+    assert dnn.optimizer is opt_class and dnn.model.optimizer is None
@@ -30,6 +30,30 @@ def test_gen_matches_file():
     g_7_default = ef.Generator(dmax=7, filename='default')
     assert np.all(g_7_default.specs == g_7.specs)
 
+@pytest.mark.gen
+def test_gen_counts():
+    pytest.importorskip('igraph')
+    g_8 = ef.Generator(dmax=8, gen_efms=False)
+    for d in range(9):
+        dmask = g_8.c_specs[:,g_8.d_ind] == d
+        assert np.count_nonzero(dmask) == table2a['prime'][d]
+        assert np.count_nonzero(g_8.specs[:,g_8.d_ind] == d) == table2a['all'][d]
+        for n in range(g_8.nmax+1):
+            nmask = g_8.c_specs[:,g_8.n_ind] == n
+            assert np.count_nonzero(dmask & nmask) == table2b[n][d]
+
+# weightings found via automorphisms and via canonical labelings should agree
+@pytest.mark.gen
+@pytest.mark.parametrize('vmax', [None, 3])
+def test_gen_weightings_paths(monkeypatch, vmax):
+    pytest.importorskip('igraph')
+    gens = []
+    for max_auts in [0, 10**9]:
+        monkeypatch.setattr(ef.gen, 'MAX_AUTOMORPHISMS', max_auts)
+        gens.append(ef.Generator(dmax=7, vmax=vmax, gen_efms=False))
+    assert gens[0].weights == gens[1].weights
+    assert np.all(gens[0].c_specs == gens[1].c_specs)
+
 g_10_default = ef.Generator(dmax=10, filename='default')
 
 sp = g_10_default.specs
@@ -16,6 +16,7 @@ from __future__ import absolute_import, division, print_function
 import numpy as np
 
 from energyflow.utils.generic_utils import import_fastjet
+from energyflow.utils.particle_utils import p4s_from_ptyphims
 
 fj = import_fastjet()
 
@@ -40,13 +41,14 @@ if fj:
             array.
         """
 
-        pjs = []
-        for ptyphim in ptyphims:
-            pj = fj.PseudoJet()
-            pj.reset_PtYPhiM(*ptyphim[:4])
-            pjs.append(pj)
+        ptyphims = np.asarray(ptyphims, dtype=float)
+        if len(ptyphims) == 0:
+            return []
 
-        return pjs
+        # get Cartesian momenta of all particles at once rather than one at a time
+        p4s = p4s_from_ptyphims(ptyphims[:,:4])
+
+        return [fj.PseudoJet(px, py, pz, e) for e, px, py, pz in p4s.tolist()]
 
     def ptyphims_from_pjs(pjs, mass=True):
         """Extracts hadronic four-vectors from FastJet PseudoJets.
@@ -144,14 +146,18 @@ if fj:
             obs/#zg_from_pj).
         """
 
+        # decluster iteratively, following the harder branch
         parent1, parent2 = fj.PseudoJet(), fj.PseudoJet()
-        if not jet.has_parents(parent1, parent2):
-            return jet
-        
-        pt1, pt2 = parent1.pt(), parent2.pt()
-        z = min(pt1, pt2)/(pt1 + pt2)
- 
-        if z >= (zcut if beta == 0 else zcut * (parent1.delta_R(parent2)/R)**beta):
-            return jet
-        else:
-            return softdrop(parent1 if pt1 >= pt2 else parent2, zcut=zcut, beta=beta, R=R)
+        while jet.has_parents(parent1, parent2):
+
+            pt1, pt2 = parent1.pt(), parent2.pt()
+            z = min(pt1, pt2)/(pt1 + pt2)
+
+            if z >= (zcut if beta == 0 else zcut * (parent1.delta_R(parent2)/R)**beta):
+                break
+
+            # the kept branch becomes the jet, so new parents are needed
+            jet = parent1 if pt1 >= pt2 else parent2
+            parent1, parent2 = fj.PseudoJet(), fj.PseudoJet()
+
+        return jet